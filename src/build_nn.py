@@ -7,6 +7,12 @@ import seaborn as sns
 # For lime deprecation warnings
 import warnings
 warnings.filterwarnings("ignore")
+import contextlib
+import json
+import subprocess
+import sys
+import tempfile
+import time
 
 # image manipulation
 from PIL import Image as im
@@ -20,6 +26,7 @@ from tensorflow.keras.layers import Dense, Dropout, Flatten, Conv2D, MaxPooling2
 from tensorflow.keras import metrics
 from keras.layers.advanced_activations import LeakyReLU
 from tensorflow.random import set_seed
+import tensorflow as tf
 
 # Diagnostics/Analysis
 from sklearn.metrics import roc_curve, auc
@@ -32,6 +39,106 @@ import datetime
 # Set global seed
 set_seed(42)
 
+################### Multi-worker helpers #######################
+
+def tf_config(num_workers, index, base_port=12345):
+    '''
+    Returns TF_CONFIG json string for worker number `index` in a cluster of `num_workers` processes on localhost.
+    Set os.environ['TF_CONFIG'] to this before calling NeuralNet.make_strategy().
+    '''
+    workers = [f'localhost:{base_port + i}' for i in range(num_workers)]
+    return json.dumps({'cluster': {'worker': workers},
+                       'task': {'type': 'worker', 'index': index}})
+
+def launch_local_workers(script, num_workers=2, base_port=12345, timeout=None, baseline=True, script_args=()):
+    '''
+    Runs `script` once per worker on this machine, each with its own TF_CONFIG, and reports scaling efficiency.
+    See src/distributed_example.py for a worker script.
+    
+    The script must:
+    - call .make_strategy() and build_model(..., distributed=True) only when TF_CONFIG is set (the baseline run has none)
+    - pass benchmark=True to build_model, which writes its throughput to the NN_RESULTS_DIR folder set here
+    
+    If a worker exits non-zero, the rest are killed (they would otherwise hang waiting on it in collective ops).
+    
+    Params
+    --------
+    :script: str, path to the worker .py file.
+    :script_args: list of str, command line arguments passed to every run of the script.
+    :num_workers: int, number of worker processes.
+    :timeout: float, seconds to wait for each run (baseline, then workers) before killing it; None waits indefinitely.
+    :baseline: bool, whether to first run the script once without TF_CONFIG as the single-process baseline.
+    
+    Returns dict with exit codes, throughputs (samples/sec) and scaling efficiency (None if a run failed).
+    '''
+    results = {'baseline_exit_code': None, 'exit_codes': None, 
+               'baseline_throughput': None, 'train_throughput': None, 'efficiency': None}
+    
+    with tempfile.TemporaryDirectory() as results_dir:
+        env = dict(os.environ, NN_RESULTS_DIR=results_dir)
+        env.pop('TF_CONFIG', None)
+        
+        if baseline:
+            print('Running single-process baseline...')
+            results['baseline_exit_code'] = _wait_for_workers([subprocess.Popen([sys.executable, script, *script_args], env=env)], timeout)[0]
+        
+        print(f'Running {num_workers} workers...')
+        procs = []
+        for i in range(num_workers):
+            worker_env = dict(env, TF_CONFIG=tf_config(num_workers, i, base_port))
+            procs.append(subprocess.Popen([sys.executable, script, *script_args], env=worker_env))
+        results['exit_codes'] = _wait_for_workers(procs, timeout)
+        
+        baseline_result = _read_result(results_dir, 'baseline')
+        chief_result = _read_result(results_dir, 'worker_0')
+    
+    if chief_result is not None:
+        results['train_throughput'] = chief_result['train_throughput']
+    if baseline_result is not None:
+        results['baseline_throughput'] = baseline_result['train_throughput']
+    
+    if baseline_result is not None and chief_result is not None:
+        results['efficiency'] = _scaling_report(chief_result['model_name'], chief_result['num_workers'], 
+                                                chief_result['num_replicas'], chief_result['train_throughput'],
+                                                baseline_result['train_throughput'])
+    else:
+        print('Missing throughput results (a run failed or build_model was not called with benchmark=True), no scaling report.')
+    return results
+
+def _wait_for_workers(procs, timeout=None):
+    '''Polls processes until all exit; kills the rest if one fails or timeout (seconds) runs out. Returns exit codes.'''
+    start = time.monotonic()
+    while any(p.poll() is None for p in procs):
+        failed = any(p.poll() not in (None, 0) for p in procs)
+        timed_out = timeout is not None and time.monotonic() - start > timeout
+        if failed or timed_out:
+            print('Worker failed, stopping remaining workers.' if failed else 'Timed out, stopping workers.')
+            for p in procs:
+                if p.poll() is None:
+                    p.kill()
+            break
+        time.sleep(1)
+    return [p.wait() for p in procs]
+
+def _read_result(results_dir, name):
+    '''Loads the json a benchmark run wrote to results_dir, or None if it never got written.'''
+    path = os.path.join(results_dir, name + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _scaling_report(model_name, num_workers, num_replicas, throughput, baseline_throughput):
+    '''
+    Prints and returns scaling efficiency = distributed throughput / (num_replicas * single-process throughput).
+    1.0 is perfect linear scaling.
+    '''
+    speedup = throughput / baseline_throughput
+    efficiency = speedup / num_replicas
+    print(f'{model_name}: {num_workers} worker(s), {num_replicas} replica(s), {throughput:.1f} samples/sec '
+          f'vs {baseline_throughput:.1f} single-process\nSpeedup: {speedup:.2f}x\nScaling efficiency: {efficiency:.1%}')
+    return efficiency
+
 ####################### Class NeuralNet ########################
 
 class NeuralNet():
@@ -119,6 +226,13 @@ class NeuralNet():
         self.history = None
         self.weights_dict = {}
         self.confusion_matrix = None
+        
+        # Distributed training
+        self.strategy = None
+        self.num_workers = 1
+        self.num_replicas = 1
+        self.train_time = None
+        self.train_throughput = None
 
     def preprocess(self, folder='data', rotation_range=0.4, zoom_range=0.4):
         '''
@@ -417,7 +531,7 @@ class NeuralNet():
             
             
     def build_model(self, model_name, layers, ternary, optimizer, loss, metrics, 
-                    epochs, batch_size, validation_split):
+                    epochs, batch_size, validation_split, distributed=False, benchmark=False):
         '''
         Uses in model-ready dataset attribute, returns None, but stores fit model object in the class. If ternary=True, then builds model that distinguishes normal vs bacterial vs viral pneumonia.
         First layer of network must contain input shape.
@@ -431,16 +545,15 @@ class NeuralNet():
         :loss: choose one of the following (str): [
         :metrics: choose from the following (tuple): [
         :epochs: int; number of big-boy rounds.
-        :batch_size: int; number of bony cliques.
+        :batch_size: int; number of bony cliques. When distributed=True, this is the batch size per replica.
         :validation_split: float; proportion of training data to be siphoned off to use for validation.
+        :distributed: bool; if True, trains data-parallel across the workers described by the TF_CONFIG env variable (see tf_config() and launch_local_workers()).
+        :benchmark: bool; if True, times the training steps and stores .train_time/.train_throughput (also written to NN_RESULTS_DIR when launched by launch_local_workers()).
+        
+        NOTE: for distributed=True, call .make_strategy() first and construct `layers`, `metrics` and `optimizer` 
+        inside `with nn.strategy.scope():` -- TF rejects metric/optimizer variables created outside the strategy scope.
         '''
         self.model_name = model_name
-        self.model = Sequential()
-        
-        for layer in layers:
-            self.model.add(layer)
-        
-        self.model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
         
         if ternary == False:
             data_images = self.binary_train_images
@@ -451,21 +564,317 @@ class NeuralNet():
         else:
             print("Must enter either bool depending on desired classifier: binary or ternary.")
         
+        if distributed == True and self.strategy is None:
+            print('Must run .make_strategy() and build layers/metrics/optimizer under .strategy.scope() before distributed training.')
+            return None
+        elif distributed == False:
+            self.strategy = None
+            self.num_workers = 1
+            self.num_replicas = 1
+        
+        # Strategy must exist before any variables are created, so model gets built inside its scope
+        with self.strategy.scope() if distributed else contextlib.nullcontext():
+            self.model = Sequential()
+            for layer in layers:
+                self.model.add(layer)
+            self.model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+        
         # create callback
+        # mirrored variables are kept in sync, so every worker records the same weights per epoch
+        self.weights_dict = {}
         weight_callback = LambdaCallback(on_epoch_end=lambda epoch, logs: self.weights_dict.update(
                                                                                             {epoch:self.model.get_weights()}
                                                                                             ))
-        log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        tensorboard_callback = TensorBoard(log_dir=log_dir, histogram_freq=1)
+        callbacks = [weight_callback]
+        
+        # only the chief writes TensorBoard logs, otherwise workers clobber each other's logs
+        if distributed == False or self._is_chief():
+            log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            callbacks.append(TensorBoard(log_dir=log_dir, histogram_freq=1))
+        
+        # times only the training steps of each epoch: stops when validation starts or, without validation,
+        # at epoch end (it runs first, before weight snapshots and histograms)
+        timer = {'epoch_start': None, 'total': 0}
+        def stop_timer():
+            if timer['epoch_start'] is not None:
+                timer['total'] += time.perf_counter() - timer['epoch_start']
+                timer['epoch_start'] = None
+        if benchmark == True:
+            timing_callback = LambdaCallback(on_epoch_begin=lambda epoch, logs: timer.update({'epoch_start': time.perf_counter()}),
+                                             on_test_begin=lambda logs: stop_timer(),
+                                             on_epoch_end=lambda epoch, logs: stop_timer())
+            callbacks.insert(0, timing_callback)
         
         # fit model with callback
-        self.history = self.model.fit(data_images,
-                                 data_labels,
-                                 epochs = epochs,
-                                 batch_size = batch_size,
-                                 validation_split = validation_split,
-                                 callbacks = [weight_callback, tensorboard_callback])
- 
+        if distributed == True:
+            train_data, val_data, steps_per_epoch, validation_steps = self._distributed_datasets(data_images, data_labels, 
+                                                                                                 batch_size, validation_split)
+            self.history = self.model.fit(train_data,
+                                     epochs = epochs,
+                                     steps_per_epoch = steps_per_epoch,
+                                     validation_data = val_data,
+                                     validation_steps = validation_steps,
+                                     callbacks = callbacks)
+            n_train = steps_per_epoch * batch_size * self.num_replicas
+        else:
+            self.history = self.model.fit(data_images,
+                                     data_labels,
+                                     epochs = epochs,
+                                     batch_size = batch_size,
+                                     validation_split = validation_split,
+                                     callbacks = callbacks)
+            n_train = int(len(data_images) * (1 - validation_split))
+        
+        if benchmark == True:
+            # samples per second across the whole job, used for scaling_efficiency()
+            self.train_time = timer['total']
+            self.train_throughput = n_train * epochs / self.train_time if self.train_time > 0 else None
+            self._write_results(distributed)
+        else:
+            self.train_time = None
+            self.train_throughput = None
+    
+    def _write_results(self, distributed):
+        '''Writes throughput json to NN_RESULTS_DIR (set by launch_local_workers()) so the launcher can report scaling.'''
+        results_dir = os.environ.get('NN_RESULTS_DIR')
+        if results_dir is None or self.train_throughput is None:
+            return
+        name = f'worker_{self._worker_info()[1]}' if distributed else 'baseline'
+        with open(os.path.join(results_dir, name + '.json'), 'w') as f:
+            json.dump({'model_name': self.model_name, 'num_workers': self.num_workers, 
+                       'num_replicas': self.num_replicas, 'train_throughput': self.train_throughput}, f)
+    
+    def make_strategy(self):
+        '''
+        Creates the MultiWorkerMirroredStrategy for the cluster described by TF_CONFIG and stores it in .strategy.
+        Must be called before any other TF work in the process; build layers, metrics and optimizer under .strategy.scope(), then .build_model(..., distributed=True).
+        '''
+        self.strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+        self.num_replicas = self.strategy.num_replicas_in_sync
+        self.num_workers = self._worker_info()[0]
+        return self.strategy
+    
+    def _distributed_datasets(self, data_images, data_labels, batch_size, validation_split):
+        '''
+        Splits arrays into train/validation tf.data.Datasets sharded across workers, returns (train, val, steps_per_epoch, validation_steps).
+        validation_split isn't supported for datasets, so the split is taken off the end like keras does.
+        '''
+        split = int(len(data_images) * (1 - validation_split))
+        global_batch_size = batch_size * self.num_replicas
+        num_workers, worker_index = self._worker_info()
+        
+        # TF 2.3 can't handle partial/uneven batches across workers, so datasets repeat forever with full batches
+        # and fit() is told how many steps make an epoch
+        steps_per_epoch = split // global_batch_size
+        validation_steps = (len(data_images) - split) // global_batch_size
+        if steps_per_epoch == 0:
+            raise ValueError(f'Not enough training data for one global batch of {global_batch_size}.')
+        
+        # sharding is done by hand below, so don't let the strategy shard again
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        
+        def make_dataset(images, labels, shuffle):
+            # shuffle/shard indices rather than images so nothing beyond the numpy arrays is held in memory
+            indices = tf.data.Dataset.range(len(images))
+            if shuffle:
+                indices = indices.shuffle(len(images), seed=42) # same seed on every worker -> disjoint shards
+            indices = indices.shard(num_workers, worker_index).repeat().batch(global_batch_size, drop_remainder=True)
+            # one numpy lookup per batch keeps the python/GIL cost off the per-sample path
+            data = indices.map(lambda i: tf.numpy_function(lambda j: (images[j].astype(np.float32), labels[j].astype(np.float32)), 
+                                                            [i], (tf.float32, tf.float32)))
+            data = data.map(lambda x, y: (tf.ensure_shape(x, (global_batch_size,) + images.shape[1:]), 
+                                          tf.ensure_shape(y, (global_batch_size,) + labels.shape[1:])))
+            return data.prefetch(1).with_options(options)
+        
+        train_data = make_dataset(data_images[:split], data_labels[:split], shuffle=True)
+        
+        val_data = None
+        if validation_steps > 0:
+            val_data = make_dataset(data_images[split:], data_labels[split:], shuffle=False)
+        else:
+            validation_steps = None
+        
+        return train_data, val_data, steps_per_epoch, validation_steps
+    
+    def _worker_info(self):
+        '''Returns (number of workers, this worker's index) from TF_CONFIG; (1, 0) when not set.'''
+        config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+        cluster = config.get('cluster', {})
+        num_workers = len(cluster.get('worker', [])) + len(cluster.get('chief', []))
+        task = config.get('task', {})
+        index = task.get('index', 0)
+        if task.get('type') == 'worker' and 'chief' in cluster:
+            index += len(cluster['chief'])
+        return max(num_workers, 1), index
+    
+    def _is_chief(self):
+        '''Checks TF_CONFIG to see whether this process is the chief (or the only) worker.'''
+        config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+        task = config.get('task', {})
+        if 'chief' in config.get('cluster', {}):
+            return task.get('type') == 'chief'
+        return task.get('type', 'worker') == 'worker' and task.get('index', 0) == 0
+    
+    def scaling_efficiency(self, baseline_throughput):
+        '''
+        Compares distributed training against a single-process run and prints/returns the scaling efficiency.
+        
+        Params
+        --------
+        :baseline_throughput: float, .train_throughput of a NeuralNet trained with distributed=False, benchmark=True on the same data.
+        
+        Efficiency = distributed throughput / (num_replicas * single-process throughput); 1.0 is perfect linear scaling.
+        Replicas are the devices training in sync (one per worker on CPU-only hosts, one per GPU otherwise).
+        To get both numbers from separate processes, use launch_local_workers() instead.
+        '''
+        if self.train_throughput is None:
+            print('Must run .build_model(..., benchmark=True) before checking scaling efficiency.')
+            return None
+        
+        return _scaling_report(self.model_name, self.num_workers, self.num_replicas, 
+                               self.train_throughput, baseline_throughput)
+        
+    def _tta_transforms(self, n_views, height, width, rotation, zoom):
+        '''
+        Returns (n_views, 8) array of projective transforms, one per test-time augmentation view.
+        Views follow the order: identity, flip, +/- rotation (degrees), zoom in/out (fraction), then the same with a horizontal flip.
+        '''
+        # (flip, degrees, zoom factor)
+        views = [(False, 0, 1), (True, 0, 1),
+                 (False, rotation, 1), (False, -rotation, 1),
+                 (False, 0, 1 - zoom), (False, 0, 1 + zoom),
+                 (True, rotation, 1), (True, -rotation, 1),
+                 (True, 0, 1 - zoom), (True, 0, 1 + zoom)]
+        views = views[:n_views]
+        
+        # Each transform maps output pixel coords to input coords, about the image center
+        cx, cy = (width - 1) / 2, (height - 1) / 2
+        transforms = []
+        for flip, degrees, z in views:
+            theta = np.deg2rad(degrees)
+            m = z * np.array([[np.cos(theta), -np.sin(theta)],
+                              [np.sin(theta), np.cos(theta)]]) @ np.diag([-1 if flip else 1, 1])
+            transforms.append([m[0,0], m[0,1], cx - m[0,0]*cx - m[0,1]*cy,
+                               m[1,0], m[1,1], cy - m[1,0]*cx - m[1,1]*cy,
+                               0, 0])
+        return np.array(transforms, dtype=np.float32)
+    
+    def check_tta_transforms(self, height=8, width=6):
+        '''
+        NumPy sanity check of the hand-built TTA transforms (flip sign, centering, zoom direction).
+        Applies each transform with nearest-pixel sampling to a random image and raises AssertionError on a mismatch:
+        - identity view leaves the image unchanged
+        - flip view equals image[:, :, ::-1]
+        - zoom-in view samples a smaller region around the center than zoom-out
+        Returns True if all checks pass.
+        '''
+        image = np.random.RandomState(42).rand(1, height, width, 3)
+        transforms = self._tta_transforms(10, height, width, rotation=10, zoom=0.2)
+        
+        def apply(transform):
+            a0, a1, a2, b0, b1, b2 = transform[:6]
+            ys, xs = np.mgrid[0:height, 0:width]
+            in_x = np.clip(np.rint(a0*xs + a1*ys + a2), 0, width - 1).astype(int)
+            in_y = np.clip(np.rint(b0*xs + b1*ys + b2), 0, height - 1).astype(int)
+            return image[:, in_y, in_x]
+        
+        assert np.allclose(apply(transforms[0]), image), 'identity view changed the image'
+        assert np.allclose(apply(transforms[1]), image[:, :, ::-1]), 'flip view is not a horizontal flip'
+        
+        # zoom in (view 4) maps the output corner closer to the center than zoom out (view 5) does
+        cx, cy = (width - 1) / 2, (height - 1) / 2
+        corner = lambda t: np.hypot(t[2] - cx, t[5] - cy)
+        assert corner(transforms[4]) < corner(transforms[5]), 'zoom views are swapped'
+        return True
+    
+    def predict_tta(self, images, n_views=6, reducer='mean', batch_size=32, rotation=10, zoom=0.2):
+        '''
+        Test-time augmentation: predicts on flipped/rotated/zoomed views of each image and aggregates them.
+        All views of a batch are generated in-graph and run through the model in a single call.
+        
+        Params
+        --------
+        :images: array of preprocessed images (N, height, width, channels), e.g. .binary_test_images
+        :n_views: int, number of views per image (1-10); 1 is plain prediction.
+        :reducer: str or callable - 'mean', 'median', 'max', 'min', or a function taking an array of shape (n_views, N, classes) and reducing over axis 0.
+                  For the binary model 'max' favours PNEUMONIA, trading false positives for fewer false negatives.
+        :batch_size: int, number of original images per fused model call (model sees batch_size * n_views images).
+        :rotation: float, degrees for the +/- rotation views.
+        :zoom: float, fraction for the zoom in/out views (0.2 -> 0.8x and 1.2x, i.e. half of preprocess' default zoom_range).
+        
+        NOTE: rotation isn't taken from preprocess' rotation_range -- ImageDataGenerator reads that in degrees, 
+        so the 0.4 default would make the rotation views near-copies of the identity view.
+        '''
+        reducers = {'mean': np.mean, 'median': np.median, 'max': np.max, 'min': np.min}
+        if callable(reducer):
+            reduce_fn = reducer
+        elif reducer in reducers:
+            reduce_fn = lambda preds: reducers[reducer](preds, axis=0)
+        else:
+            print(f"Reducer must be callable or one of the following: {list(reducers)}")
+            return None
+        
+        if n_views < 1 or n_views > 10:
+            print('n_views must be between 1 and 10.')
+            return None
+        if not 0 <= zoom < 1:
+            print('zoom must be at least 0 and less than 1.')
+            return None
+        if len(images) == 0:
+            print('No images to predict on.')
+            return None
+        
+        images = np.asarray(images, dtype=np.float32)
+        height, width = images.shape[1:3]
+        transforms = self._tta_transforms(n_views, height, width, rotation, zoom)
+        
+        preds = []
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start+batch_size]
+            # view-major tiling: all images under view 0, then view 1, ...
+            # TF 2.3 has no NEAREST fill (ImageDataGenerator's default), so edges are mirrored instead of
+            # smeared; only the thin border exposed by rotation/zoom-out differs
+            tiled = np.tile(batch, (n_views, 1, 1, 1))
+            batch_transforms = np.repeat(transforms, len(batch), axis=0)
+            views = tf.raw_ops.ImageProjectiveTransformV2(images=tiled,
+                                                          transforms=batch_transforms,
+                                                          output_shape=[height, width],
+                                                          interpolation='BILINEAR',
+                                                          fill_mode='REFLECT')
+            batch_preds = self.model.predict_on_batch(views)
+            batch_preds = np.asarray(batch_preds).reshape(n_views, len(batch), -1)
+            preds.append(reduce_fn(batch_preds))
+        
+        return np.concatenate(preds, axis=0)
+    
+    def tta_latency(self, images, max_views=6, batch_size=32, repeats=5, **tta_kwargs):
+        '''
+        Times predict_tta for 1 through max_views views on `images` and prints the latency cost per additional view.
+        Each view count is warmed up first (new fused batch shapes retrace the model), then timed as the median of `repeats` runs.
+        Extra keyword args (reducer, rotation, zoom) are passed to predict_tta.
+        Returns dict of {n_views: seconds}, or None if predict_tta rejects the inputs.
+        '''
+        timings = {}
+        for n in range(1, max_views+1):
+            # warm-up so graph tracing for this batch shape isn't counted; also catches invalid inputs,
+            # which would otherwise be timed as near-instant no-ops
+            if self.predict_tta(images, n_views=n, batch_size=batch_size, **tta_kwargs) is None:
+                return None
+            runs = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                self.predict_tta(images, n_views=n, batch_size=batch_size, **tta_kwargs)
+                runs.append(time.perf_counter() - start)
+            timings[n] = np.median(runs)
+        
+        base = timings[1]
+        for n, t in timings.items():
+            print(f'{n} view(s): {t*1000:.1f} ms total, {t*1000/len(images):.2f} ms/image, {t/base:.2f}x single view')
+        if max_views > 1:
+            per_view = (timings[max_views] - base) / (max_views - 1)
+            print(f'Cost per additional view: {per_view*1000:.1f} ms ({per_view*1000/len(images):.2f} ms/image)')
+        return timings
         
     def get_results(self, graph_name, num_classes=None, y_pred=None, y_true=None, recall_type='recall'):
         '''
@@ -0,0 +1,56 @@
+'''
+Example worker script for multi-worker training on one host.
+
+Run it directly to launch a single-process baseline plus 2 local workers and print the scaling efficiency:
+
+    python src/distributed_example.py [data folder] [number of workers]
+
+launch_local_workers() then re-runs this file in each worker process (with NN_RESULTS_DIR set),
+where it trains a small binary CNN instead of launching.
+'''
+import contextlib
+import os
+import sys
+
+from build_nn import NeuralNet, launch_local_workers
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import Dense, Flatten, Conv2D, MaxPooling2D
+from tensorflow.keras import metrics
+from tensorflow.keras.optimizers import Adam
+
+
+def train(folder):
+    nn = NeuralNet()
+
+    # baseline run has no TF_CONFIG; strategy must be created before any other TF work
+    distributed = 'TF_CONFIG' in os.environ
+    if distributed:
+        nn.make_strategy()
+
+    nn.preprocess(folder=folder)
+
+    # layers, metrics and optimizer all create variables, so they belong under the strategy scope
+    with nn.strategy.scope() if distributed else contextlib.nullcontext():
+        layers = [Conv2D(16, (3, 3), activation='relu', input_shape=(224, 224, 3)),
+                  MaxPooling2D((2, 2)),
+                  Flatten(),
+                  Dense(1, activation='sigmoid')]
+        model_metrics = ['accuracy', metrics.Recall()]
+        optimizer = Adam()
+
+    nn.build_model('distributed_example', layers, ternary=False, optimizer=optimizer,
+                   loss='binary_crossentropy', metrics=model_metrics, epochs=2, batch_size=32,
+                   validation_split=0.1, distributed=distributed, benchmark=True)
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else 'data'
+
+    if 'NN_RESULTS_DIR' in os.environ:
+        train(folder)
+    else:
+        num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        # workers re-run this file, so pass the data folder along
+        results = launch_local_workers(os.path.abspath(__file__), num_workers=num_workers,
+                                       script_args=[folder])
+        print(results)